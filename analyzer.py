@@ -7,16 +7,25 @@
 # pyright: strict
 
 import argparse
+import ast
+import concurrent.futures
+import functools
 import inspect
 import importlib
 import os
+import types
 import typing as t
 from pathlib import Path
 
-import libcst as cst
+# Use the Rust-backed parser for every cst.parse_* call, it's noticeably
+# faster than the pure python one and produces the same tree
+os.environ.setdefault("LIBCST_PARSER_TYPE", "native")
+
+if t.TYPE_CHECKING:
+    import libcst as cst
 
 IGNORE_NAMES: t.Sequence[str] = (
-    "__pycache__"
+    "__pycache__",
 )
 
 parser = argparse.ArgumentParser(
@@ -31,173 +40,227 @@ parser.add_argument("-v", "--verbose", required=False, action="store_true", help
 
 args = parser.parse_args()
 
-class GenericClassVisitor(cst.CSTVisitor):
+_VERBOSE: bool = args.verbose
+
+class GenericClassVisitor:
     __slots__: t.Sequence[str] = ("_generic_class_names", "_typevar_name", "_typevars")
 
     def __init__(self) -> None:
         self._generic_class_names: list[str] = []
         self._typevar_name: str = ""
-        self._typevars: list[str] = []
+        self._typevars: set[str] = set()
 
     @property
     def generic_class_names(self) -> list[str]:
         return self._generic_class_names
 
-    def visit_Assign(self, node: cst.Assign) -> None:
+    def visit(self, tree: ast.Module) -> None:
+        # Only four statement kinds matter here, so dispatch with direct
+        # isinstance checks instead of paying ast.NodeVisitor's
+        # per-node getattr lookup for the entire tree
+        for stmt in tree.body:
+            if isinstance(stmt, ast.ClassDef):
+                self.visit_ClassDef(stmt)
+
+            elif isinstance(stmt, ast.Assign):
+                self.visit_Assign(stmt)
+
+            elif isinstance(stmt, ast.Import):
+                self.visit_Import(stmt)
+
+            elif isinstance(stmt, ast.ImportFrom):
+                self.visit_ImportFrom(stmt)
+
+    def visit_Assign(self, node: ast.Assign) -> None:
         # Can't create a type variable if TypeVar wasn't imported
         if self._typevar_name == "": return
 
-        if not isinstance(node.value, cst.Call):
+        if not isinstance(node.value, ast.Call):
+            return
+
+        # Tuple/attribute/subscript targets can't bind a TypeVar name
+        target = node.targets[0]
+        if not isinstance(target, ast.Name):
             return
-        
-        var_name = t.cast(str, node.targets[0].target.value)
-        
+
+        var_name = target.id
+
         func = node.value.func
         # Can't create a type variable using dot notation and from typing import TypeVar at the same time
-        if isinstance(func, cst.Attribute):
+        if isinstance(func, ast.Attribute):
             if "." not in self._typevar_name:
                 return
-            
-            module, name = self._typevar_name.split(".")
-            if (func.value.value, func.attr.value) == (module, name): # typevar call matches type var import
-                self._typevars.append(var_name)
 
-        elif isinstance(func, cst.Name):
-            if func.value != self._typevar_name:
+            module, _, name = self._typevar_name.rpartition(".")
+            if isinstance(func.value, ast.Name) and (func.value.id, func.attr) == (module, name): # typevar call matches type var import
+                self._typevars.add(var_name)
+
+        elif isinstance(func, ast.Name):
+            if func.id != self._typevar_name:
                 return
-            
-            self._typevars.append(var_name)
 
+            self._typevars.add(var_name)
 
-    def visit_Import(self, node: cst.Import) -> None:
+
+    def visit_Import(self, node: ast.Import) -> None:
         name = self._find_TypeVar(node, "typing")
         if name is not None:
             self._typevar_name = f"{name}.TypeVar"
-        
-    def visit_ImportFrom(self, node: cst.ImportFrom):
-        if node.module is None:
-            return
-        
-        if node.module.value != "typing":
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        if node.module != "typing":
             return
-        
-        if isinstance(node.names, cst.ImportStar):
-            self._typevar_name = "TypeVar"    
+
+        if node.names[0].name == "*":
+            self._typevar_name = "TypeVar"
 
         else:
             name = self._find_TypeVar(node, "TypeVar")
             if name is not None:
                 self._typevar_name = name
 
-    def _find_TypeVar(self, node: t.Union[cst.Import, cst.ImportFrom], namespace: str) -> t.Optional[str]:
-        assert not isinstance(node.names, cst.ImportStar)
+    def _find_TypeVar(self, node: t.Union[ast.Import, ast.ImportFrom], namespace: str) -> t.Optional[str]:
         for alias in node.names:
-            origin_name = t.cast(str, alias.name.value)
+            origin_name = alias.name
             if origin_name != namespace:
                 continue
 
             if alias.asname is not None:
-                origin_name = cst.ensure_type(alias.asname.name, cst.Name).value
+                origin_name = alias.asname
 
             return origin_name
 
-    def visit_ClassDef(self, node: cst.ClassDef) -> None:
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
         # class uses type parameter syntax so it's generic
-        if node.type_parameters is not None:
-            self._generic_class_names.append(node.name.value)
+        if node.type_params:
+            self._generic_class_names.append(node.name)
 
         else: # Check if the bases contain type subscripts using previously declared TypeVars
             for base in node.bases:
-                if not isinstance(base.value, cst.Subscript):
+                if not isinstance(base, ast.Subscript):
                     continue
 
-                slice_ = base.value.slice
-                for subscript in slice_:
-                    if subscript.slice.value.value in self._typevars:
-                        self._generic_class_names.append(node.name.value)
+                slice_ = base.slice
+                subscripts = slice_.elts if isinstance(slice_, ast.Tuple) else [slice_]
+                for subscript in subscripts:
+                    if isinstance(subscript, ast.Name) and subscript.id in self._typevars:
+                        self._generic_class_names.append(node.name)
                         return
-                    
 
-class FileTransformer(cst.CSTTransformer):
-    __slots__: t.Sequence[str] = ("_generic_class_names", "_generic_alias_cls")
 
-    def __init__(self, generic_class_names: list[str]) -> None:
-        self._generic_class_names = generic_class_names
-        self._generic_alias_cls: str = ""
+@functools.lru_cache(maxsize=1)
+def _get_file_transformer() -> "t.Callable[[frozenset[str]], cst.CSTTransformer]":
+    # Deliberately a lazy factory: importing libcst pulls in a large
+    # extension module and costs a noticeable chunk of cold-start time which
+    # runs that never rewrite a file shouldn't pay. The transformer class has
+    # to be created in here because its base class lives in libcst.
+    import libcst as cst
 
-    def visit_Import(self, node: cst.Import) -> None:
-        name = self._find_GenericAlias(node, "types")
-        if name is not None:
-            self._generic_alias_cls = f"{name}.GenericAlias"
-        
-    def visit_ImportFrom(self, node: cst.ImportFrom):
-        if node.module.value != "types":
-            return
-        
-        if isinstance(node.names, cst.ImportStar):
-            self._generic_alias_cls = "GenericAlias"    
+    _import_types_stmt = cst.parse_statement("from types import GenericAlias")
 
-        else:
-            name = self._find_GenericAlias(node, "GenericAlias")
+    class FileTransformer(cst.CSTTransformer):
+        __slots__: t.Sequence[str] = ("_generic_class_names", "_generic_alias_cls", "_cached_getitem_stmt")
+
+        def __init__(self, generic_class_names: frozenset[str]) -> None:
+            self._generic_class_names = generic_class_names
+            self._generic_alias_cls: str = ""
+            self._cached_getitem_stmt: t.Optional[cst.BaseStatement] = None
+
+        def visit_Import(self, node: cst.Import) -> None:
+            name = self._find_GenericAlias(node, "types")
             if name is not None:
-                self._generic_alias_cls = name
+                self._generic_alias_cls = f"{name}.GenericAlias"
 
-    def _find_GenericAlias(self, node: t.Union[cst.Import, cst.ImportFrom], namespace: str) -> t.Optional[str]:
-        assert not isinstance(node.names, cst.ImportStar)
-        for alias in node.names:
-            origin_name = t.cast(str, alias.name.value)
-            if origin_name != namespace:
-                continue
+        def visit_ImportFrom(self, node: cst.ImportFrom):
+            if node.module.value != "types":
+                return
 
-            if alias.asname is not None:
-                origin_name = cst.ensure_type(alias.asname.name, cst.Name).value
+            if isinstance(node.names, cst.ImportStar):
+                self._generic_alias_cls = "GenericAlias"
 
-            return origin_name
+            else:
+                name = self._find_GenericAlias(node, "GenericAlias")
+                if name is not None:
+                    self._generic_alias_cls = name
 
-    def leave_ClassDef(self, original_node: cst.ClassDef, updated_node: cst.ClassDef) -> t.Union[cst.ClassDef, cst.FlattenSentinel]:
-        #print(dump(updated_node))
-        if original_node.name.value in self._generic_class_names:
-            _import_stmt: t.Optional[bool] = None
+        def _find_GenericAlias(self, node: t.Union[cst.Import, cst.ImportFrom], namespace: str) -> t.Optional[str]:
+            assert not isinstance(node.names, cst.ImportStar)
+            for alias in node.names:
+                origin_name = t.cast(str, alias.name.value)
+                if origin_name != namespace:
+                    continue
 
-            if self._generic_alias_cls == "":
-                _import_stmt = cst.parse_statement("from types import GenericAlias")
-                self._generic_alias_cls = "GenericAlias"
-                
-            __class_getitem__Node = cst.parse_statement(
-                f"__class_getitem__ = classmethod({self._generic_alias_cls})"
-            )
-            statements = original_node.body.body
-            if isinstance(original_node.body, cst.SimpleStatementSuite):
-                statements = [cst.SimpleStatementLine(statements)]
-
-            updated_node = updated_node.with_changes(
-                body=cst.IndentedBlock(
-                    body=(
-                        *statements,
-                        __class_getitem__Node
+                if alias.asname is not None:
+                    origin_name = cst.ensure_type(alias.asname.name, cst.Name).value
+
+                return origin_name
+
+        def leave_ClassDef(self, original_node: cst.ClassDef, updated_node: cst.ClassDef) -> t.Union[cst.ClassDef, cst.FlattenSentinel]:
+            #print(dump(updated_node))
+            if original_node.name.value in self._generic_class_names:
+                _import_stmt: t.Optional[cst.BaseStatement] = None
+
+                if self._generic_alias_cls == "":
+                    _import_stmt = _import_types_stmt
+                    self._generic_alias_cls = "GenericAlias"
+
+                # The statement is identical for every class in the file, so parse
+                # it once and reuse the node (libcst nodes are immutable)
+                if self._cached_getitem_stmt is None:
+                    self._cached_getitem_stmt = cst.parse_statement(
+                        f"__class_getitem__ = classmethod({self._generic_alias_cls})"
+                    )
+
+                __class_getitem__Node = self._cached_getitem_stmt
+                statements = original_node.body.body
+                if isinstance(original_node.body, cst.SimpleStatementSuite):
+                    statements = [cst.SimpleStatementLine(statements)]
+
+                updated_node = updated_node.with_changes(
+                    body=cst.IndentedBlock(
+                        body=(
+                            *statements,
+                            __class_getitem__Node
+                        )
                     )
                 )
-            )
 
-            if _import_stmt is not None:
-                return cst.FlattenSentinel((_import_stmt, updated_node))
-        
-        return updated_node
+                if _import_stmt is not None:
+                    return cst.FlattenSentinel((_import_stmt, updated_node))
+
+            return updated_node
 
-def _convert_to_module_path(path: Path, ext: str) -> str:
-    return ".".join(path.parts).rstrip(ext)
+    return FileTransformer
 
-def _log(message: str) -> None:
-    if args.verbose is True:
-        print(message)
+def _convert_to_module_path(path: Path) -> str:
+    # Note: rstrip(ext) is not suitable here, it strips any run of the
+    # characters in ext so module names ending in e.g. "p" or "y" get mangled
+    return ".".join(path.with_suffix("").parts)
 
-def _get_ast(p: Path) -> cst.Module:
-    with open(str(p)) as f:
+@functools.lru_cache(maxsize=None)
+def _parse_module_cached(path: str, mtime: float) -> "cst.Module":
+    import libcst as cst
+
+    # Hand the parser raw bytes, it does its own (encoding-aware) decoding
+    with open(path, "rb") as f:
         return cst.parse_module(f.read())
 
+def _get_ast(p: Path) -> "cst.Module":
+    # Keyed by mtime as well so a file rewritten by --fix isn't served stale
+    return _parse_module_cached(str(p), os.path.getmtime(p))
+
+_imported_modules: dict[str, types.ModuleType] = {}
+
+def _import_module(import_path: str) -> types.ModuleType:
+    module = _imported_modules.get(import_path)
+    if module is None:
+        module = _imported_modules[import_path] = importlib.import_module(import_path)
+
+    return module
+
 def _get_runtime_generic_classes(path: Path) -> list[str]:
-    stubs_import_path = _convert_to_module_path(path, ".pyi")
-    module = importlib.import_module(stubs_import_path)
+    stubs_import_path = _convert_to_module_path(path)
+    module = _import_module(stubs_import_path)
 
     def predicate(obj: t.Any) -> bool:
         return (
@@ -206,15 +269,33 @@ def _get_runtime_generic_classes(path: Path) -> list[str]:
             and hasattr(obj, "__class_getitem__")
         )
     
+    # vars(module) is the module __dict__ itself, unlike inspect.getmembers
+    # which sorts dir() and getattrs every name including inherited dunders
     generic_classes: list[str] = [
-        name for name, _ in inspect.getmembers(module, predicate)
+        name for name, obj in vars(module).items() if predicate(obj)
     ]
     return generic_classes
 
 def _get_ast_generic_classes(path: Path) -> list[str]:
-    tree = _get_ast(path)
+    tree = ast.parse(path.read_bytes(), filename=str(path))
+
+    # Stubs written against python 3.12+ declare generics through the type
+    # parameter syntax alone. If no class has a subscripted base there are no
+    # TypeVar bindings worth tracking, so the visitor can be skipped entirely
+    has_subscripted_base = any(
+        isinstance(base, ast.Subscript)
+        for stmt in tree.body if isinstance(stmt, ast.ClassDef)
+        for base in stmt.bases
+    )
+    if not has_subscripted_base:
+        return [
+            stmt.name
+            for stmt in tree.body
+            if isinstance(stmt, ast.ClassDef) and stmt.type_params
+        ]
+
     visitor = GenericClassVisitor()
-    tree.visit(visitor)
+    visitor.visit(tree)
 
     return visitor.generic_class_names
 
@@ -228,84 +309,143 @@ if args.runtime:
 else:
     get_generic_classes = _get_ast_generic_classes
 
-def compare_files(path_to_impl: Path, path_to_stub: Path, *, fix: bool) -> None:
-    _log(f"Comparing {path_to_stub} with {path_to_impl}")
+def compare_files(path_to_impl: Path, path_to_stub: Path, *, fix: bool) -> list[str]:
+    # Messages are collected and returned instead of printed so that workers
+    # running in parallel don't interleave their output. The _VERBOSE checks
+    # sit at the call sites on purpose: that way the f-strings aren't even
+    # built when --verbose is off
+    messages: list[str] = []
+
+    if _VERBOSE:
+        messages.append(f"Comparing {path_to_stub} with {path_to_impl}")
+
     try:
         generic_classes = get_generic_classes(path_to_stub)
 
-    except:
-        _log(f"Could not parse {path_to_stub}. Skipping.")
-        return
-    
+    except (SyntaxError, ValueError, ImportError) as e:
+        if _VERBOSE:
+            messages.append(f"Could not parse {path_to_stub} ({e}). Skipping.")
+
+        return messages
+
     if not generic_classes:
-        _log(f"{path_to_stub} does not contain any generic classes. Skipping.")
-        return
-    
-    _log(f"Found the following generic classes in {path_to_stub}: {', '.join(generic_classes)}")
+        if _VERBOSE:
+            messages.append(f"{path_to_stub} does not contain any generic classes. Skipping.")
+
+        return messages
+
+    if _VERBOSE:
+        messages.append(f"Found the following generic classes in {path_to_stub}: {', '.join(generic_classes)}")
 
-    impl_import_path = _convert_to_module_path(path_to_impl, ".py")
+    impl_import_path = _convert_to_module_path(path_to_impl)
     try:
-        module = importlib.import_module(impl_import_path)
+        module = _import_module(impl_import_path)
+
+    except (ImportError, SyntaxError) as e:
+        # Anything else is a real bug in the implementation module and should
+        # propagate instead of being silently swallowed
+        if _VERBOSE:
+            messages.append(f"Could not check runtime subscription support for {path_to_impl} ({impl_import_path}): {e}. Skipping.")
+
+        return messages
 
-    except: 
-        _log(f"Could not check runtime subscription support for {path_to_impl} ({impl_import_path}). Skipping.")
-        return
-    
     non_subscriptable_classes: list[str] = []
+    generic_classes_set = frozenset(generic_classes)
 
-    for name, cls in inspect.getmembers(module, inspect.isclass):
-        if cls.__module__ != impl_import_path:
+    for name, cls in vars(module).items():
+        if not inspect.isclass(cls) or cls.__module__ != impl_import_path:
             continue
 
-        if hasattr(cls, "__class_getitem__") is False and name in generic_classes:
+        if hasattr(cls, "__class_getitem__") is False and name in generic_classes_set:
             non_subscriptable_classes.append(name)
-            print(f"ERROR: {cls.__module__}.{cls.__qualname__} is marked as subscriptable in {path_to_stub} but is not subscriptable at runtime")
+            messages.append(f"ERROR: {cls.__module__}.{cls.__qualname__} is marked as subscriptable in {path_to_stub} but is not subscriptable at runtime")
 
     if not non_subscriptable_classes:
-        _log("All classes checked support subscription.")
+        if _VERBOSE:
+            messages.append("All classes checked support subscription.")
 
     elif fix is True:
-        _log(f"--fix is enabled, will be fixing the following classes: {', '.join(non_subscriptable_classes)}")
+        if _VERBOSE:
+            messages.append(f"--fix is enabled, will be fixing the following classes: {', '.join(non_subscriptable_classes)}")
+
+        import libcst as cst
+
         tree = _get_ast(path_to_impl)
-        visitor = FileTransformer(non_subscriptable_classes)
-        modified_tree = tree.visit(visitor)
-        with open(path_to_impl, "w") as f:
-            f.write(modified_tree.code)
+        visitor = _get_file_transformer()(frozenset(non_subscriptable_classes))
+        # The tree comes straight from the parser and shares no nodes, so the
+        # defensive deep copy MetadataWrapper makes by default can be skipped
+        modified_tree = cst.MetadataWrapper(tree, unsafe_skip_copy=True).visit(visitor)
+        # A class can exist at runtime without a matching ClassDef in the
+        # source (when it's created dynamically for example), in which case
+        # the transformer changed nothing and rewriting the file would only
+        # churn its mtime
+        if modified_tree.deep_equals(tree) is False:
+            with open(path_to_impl, "w") as f:
+                f.write(modified_tree.code)
+
+    return messages
+
+def _walk(path_to_impl: Path, path_to_stub: Path) -> t.Iterator[tuple[Path, Path]]:
+    # os.scandir hands out DirEntry objects whose is_dir/is_file use the type
+    # information from the directory listing itself, so unlike Path.iterdir
+    # the stub side of the tree isn't stat'ed once per check
+    with os.scandir(path_to_stub) as entries:
+        for entry in entries:
+            if entry.name in IGNORE_NAMES:
+                if _VERBOSE:
+                    print(f"{entry.path} is __pycache__. Skipping.")
 
-def compare_dirs(path_to_impl: Path, path_to_stub: Path, *, fix: bool) -> None:
-    for p in path_to_stub.iterdir():
-        name = os.sep.join(p.parts[len(path_to_stub.parts):])
-        if name in IGNORE_NAMES:
-            _log(f"{p} is __pycache__. Skipping.")
-            continue
+                continue
 
-        if p.suffix == ".pyi":
-            name = name.replace(p.suffix, ".py")
+            name = entry.name
+            if name.endswith(".pyi"):
+                name = name.removesuffix(".pyi") + ".py"
 
-        impl_path = path_to_impl / name
-        if impl_path.exists() is False:
-            _log(f"ERROR: No matching implementation for stub file {p}, {impl_path} does not exist. Skipping.")  
-            continue
+            impl_path = path_to_impl / name
+            if impl_path.exists() is False:
+                if _VERBOSE:
+                    print(f"ERROR: No matching implementation for stub file {entry.path}, {impl_path} does not exist. Skipping.")
 
-        if p.is_dir() and impl_path.is_dir():
-            compare_dirs(impl_path, p, fix=fix)
+                continue
 
-        elif p.is_file() and impl_path.is_file():
-            compare_files(impl_path, p, fix=fix)
+            if entry.is_dir(follow_symlinks=False) and impl_path.is_dir():
+                yield from _walk(impl_path, Path(entry.path))
 
-        else:
-            _log(f"ERROR: Can't compare directory to file (comparing {p} with {impl_path} failed). Skipping.")
-            continue
+            elif entry.is_file(follow_symlinks=False) and impl_path.is_file():
+                yield (impl_path, Path(entry.path))
 
+            else:
+                if _VERBOSE:
+                    print(f"ERROR: Can't compare directory to file (comparing {entry.path} with {impl_path} failed). Skipping.")
+
+                continue
+
+def compare_dirs(path_to_impl: Path, path_to_stub: Path, *, fix: bool) -> None:
+    # Each (impl, stub) pair is independent and CPU-bound on parsing, so fan
+    # the files out to one worker process per core. A file is only ever
+    # touched by a single worker which keeps the --fix writes safe.
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        # Submitting straight from the walk generator pipelines the two
+        # stages: workers already parse the first files while the directory
+        # scan is still going
+        results = [
+            executor.submit(compare_files, impl_path, stub_path, fix=fix)
+            for impl_path, stub_path in _walk(path_to_impl, path_to_stub)
+        ]
+        for result in results:
+            for message in result.result():
+                print(message)
 
 def main(path_to_impl: Path, path_to_stub: Path, *, fix: bool=False) -> None:
     if path_to_impl.is_dir() and path_to_stub.is_dir():
         compare_dirs(path_to_impl, path_to_stub, fix=fix)
 
     elif path_to_impl.is_file() and path_to_stub.is_file():
-        compare_files(path_to_impl, path_to_stub, fix=fix)
+        for message in compare_files(path_to_impl, path_to_stub, fix=fix):
+            print(message)
 
     else:
         print("ERROR: Can't compare directory with file.")
 
-main(args.path, args.stubs, fix=args.fix)
\ No newline at end of file
+if __name__ == "__main__":
+    main(args.path, args.stubs, fix=args.fix)
\ No newline at end of file